@@ -4,8 +4,8 @@
 """
 
 import datetime
+import io
 import json
-import pytz
 import sys
 
 
@@ -13,45 +13,58 @@ def main():
     args = sys.argv
     oldest_dt = datetime.datetime.strptime(args[1], '%Y-%m-%d')
     latest_dt = datetime.datetime.strptime(args[2], '%Y-%m-%d')
-    
+    parallel = 1
+    if '--parallel' in args:
+        flag_idx = args.index('--parallel')
+        if flag_idx + 1 >= len(args):
+            print('--parallel requires a value.')
+            sys.exit(1)
+        try:
+            parallel = int(args[flag_idx + 1])
+        except ValueError:
+            print('--parallel must be an integer.')
+            sys.exit(1)
+
     # check
     if oldest_dt >= latest_dt:
         print('oldest_dt must be less than latest_dt.')
         sys.exit(1)
-    
+    if parallel < 1:
+        print('--parallel must be 1 or more.')
+        sys.exit(1)
+
     # split day by day
-    intervals = []
-    _start = oldest_dt
-    _end = _start + datetime.timedelta(days=1)
-    while _end <= latest_dt:
-        intervals.append([_start.timestamp(), _end.timestamp()])
-        _start = _end
-        _end = _start + datetime.timedelta(days=1)
-    
+    # timestamp()を端点で1回ずつ呼んでおけば、あとは1日=86400秒の等差数列で済む
+    base_ts = oldest_dt.timestamp()
+    n_days = (latest_dt - oldest_dt).days
+    intervals = [(base_ts + i * 86400, base_ts + (i + 1) * 86400)
+                 for i in range(n_days)]
+
     # make script string
-    base_str = "python main.py"
-    cmd_lines = []
-    for i, interv in enumerate(intervals):
-        comment_str = "echo exec call function {}".format(i+1)
-        cmd_lines.append(comment_str)
-        
-        opt_str = f"{interv[1]} {interv[0]}"  # latest_ut oldest_ut
-        cmd_lines.append(base_str + " " + opt_str)
+    # 中間リストを作らず、バッファに直接書いて最後に1回のwriteで出力する
+    # 各日の取得はSlack API待ちが支配的なので、xargs -P で日単位に並列実行する
+    buf = io.StringIO()
+    buf.write("#!/bin/sh\n")
+    buf.write(f"xargs -t -P {parallel} -L1 python main.py <<'EOF'\n")
+    for start_ts, end_ts in intervals:
+        buf.write(f"{end_ts} {start_ts}\n")  # latest_ut oldest_ut
+    buf.write("EOF\n")
 
     # write script
-    with open('call_functions_batch.sh', 'w') as f:
-        f.write("\n".join(cmd_lines))
+    with open('call_functions_batch.sh', 'w', newline='\n') as f:
+        f.write(buf.getvalue())
 
 
 if __name__ == "__main__":
     args = sys.argv
     
     # parse args
-    if len(args) != 3:
-        print('3 args are required.')
+    if len(args) < 3:
+        print('2 positional args are required.')
         print('{} args are input.'.format(len(args)))
         print('1st positional arg is oldest date (YYYY-MM-DD)')
         print('2nd positional arg is latest date (YYYY-MM-DD)')
+        print('optional: --parallel N (run N days concurrently, default 1)')
         sys.exit(1)
     main()
 
@@ -1,47 +1,195 @@
+import atexit
 import datetime
+import gzip
 import io
-import json
 import logging
+import orjson
 import os
-import pytz
+import queue
 import shutil
 import sys
 import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging.handlers import QueueHandler, QueueListener
 from flask import Request
 from pathlib import Path
 from slack_bolt import App
 from slack_sdk import errors
-from typing import List
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import ConnectionErrorRetryHandler
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from typing import Iterator, List
+from zoneinfo import ZoneInfo
+
+
+# importした時点でログファイルを作らないよう、設定は初回実行時まで遅延させる
+logfilename = None
+_logging_configured = False
+
+
+def _configure_logging():
+    """ファイルへの書き込みはQueueListenerのバックグラウンドスレッドに任せ、
+        ダウンロードスレッドからのlogging呼び出しをディスクI/Oでブロックさせない。
+    """
+    global logfilename, _logging_configured
+    if _logging_configured is True:
+        return
+    logfilename = 'ingest_log_at_{}.log'.format(datetime.datetime.now().isoformat())
+    file_handler = logging.FileHandler(logfilename, mode='a', encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s %(message)s', datefmt='%Y-%m-%d %I:%M:%S %p'))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)  # プロセス終了時にキューをflushする
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    _logging_configured = True
 
 
-logfilename = 'ingest_log_at_{}.log'.format(datetime.datetime.now().isoformat())
-logging.basicConfig(
-    filename=logfilename,
-    format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %I:%M:%S %p',
-    level=logging.INFO)
 SCRIPT_DIR = str(Path(__file__).resolve().parent)
+SLACK_LAKE_DIR = Path(SCRIPT_DIR) / 'slack_lake'
+CACHE_DIR = SCRIPT_DIR + '/.cache'
+CACHE_TTL_SECONDS = 24 * 60 * 60
+# conversations.history is a Tier-3 method (about 50 requests per minute)
+MAX_DOWNLOAD_WORKERS = 8
+HISTORY_REQUESTS_PER_MINUTE = 50
+GZIP_COMPRESS_LEVEL = 3
+HISTORY_WRITE_BUFFER_BYTES = 1 << 20
+MAX_RETRY_COUNT = 5
+
+# Cloud Functionのウォームスタートやバッチ連続実行でクライアントを再生成しないよう
+# モジュールスコープで1度だけ初期化する（HTTPコネクションプールも再利用される）
+_app = None
+_client = None
+
+
+def _add_retry_handlers(client: WebClient) -> WebClient:
+    """429はRetry-Afterに従って、コネクション断は少し待って自動リトライさせる。"""
+    client.retry_handlers.append(
+        RateLimitErrorRetryHandler(max_retry_count=MAX_RETRY_COUNT))
+    client.retry_handlers.append(
+        ConnectionErrorRetryHandler(max_retry_count=MAX_RETRY_COUNT))
+    return client
+
+
+def _get_app() -> App:
+    global _app
+    if _app is None:
+        _app = App(
+            # process_before_response must be True when running on FaaS
+            process_before_response=True,
+            token=os.environ.get("SLACK_BOT_TOKEN"),
+            signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+        )
+        _add_retry_handlers(_app.client)
+    return _app
 
 
-def download_conversations_list(client, page_limit: int) -> List[dict]:
-    """download Slack Web API conversations.list response.
+def _get_client() -> WebClient:
+    """Web APIだけ使うCLI/バッチ実行用の軽量クライアント。
+        slack_bolt.App（署名検証・リスナー等）の初期化を丸ごと省略できる。
+    """
+    global _client
+    if _client is None:
+        _client = _add_retry_handlers(
+            WebClient(token=os.environ.get("SLACK_BOT_TOKEN")))
+    return _client
+
+
+class RateLimiter:
+    """limit Slack Web API calls to max_calls per period seconds.
+        Thread-safe. Call acquire() before each API request.
+    """
+    def __init__(self, max_calls: int, period: float=60.0):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while len(self._calls) > 0 and self._calls[0] <= now - self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                wait_time = self._calls[0] + self.period - now
+            time.sleep(wait_time)
+
+
+def cached_slack_call(cache_path: str, ttl_seconds: float, fetch_fn,
+                      min_mtime: float=None):
+    """call fetch_fn with a local JSON file cache.
+        - cache_path が ttl_seconds 以内に更新されていればそれを返す
+        - min_mtime を指定した場合、それより古いスナップショットは
+          TTL内でも使わない（取得期間より古い情報で判定しないため）
+        - キャッシュが使えなければ fetch_fn() を呼び、結果をアトミックに書き込む
         Returns:
-            [{"id":xx, "name":yy}, {}, ...]
+            fetch_fn() と同じ形式のデータ
+    """
+    try:
+        mtime = os.stat(cache_path).st_mtime
+        if mtime > time.time() - ttl_seconds and (min_mtime is None or mtime >= min_mtime):
+            with open(cache_path, 'rb') as f:
+                logging.info('use cache %s', cache_path)
+                return orjson.loads(f.read())
+    except OSError:
+        pass
+
+    data = fetch_fn()
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            'wb', dir=cache_dir, delete=False) as tmp:
+        tmp.write(orjson.dumps(data))
+    os.replace(tmp.name, cache_path)
+    logging.info('update cache %s', cache_path)
+    return data
+
+
+def paginate(method, result_key: str,
+             rate_limiter: RateLimiter=None, **kwargs) -> Iterator[dict]:
+    """iterate a cursor-paginated Slack Web API method.
+        3つのdownload_*関数に重複していたカーソルループの共通部分。
+        Arguments:
+            - method: client.conversations_list などのバウンドメソッド
+            - result_key: レスポンス内のアイテム配列のキー（'channels'など）
+        Yields:
+            各ページのアイテム（dict）
     """
-    channels = []
-    next_obj_exists = True
     next_cursor = None
-    while next_obj_exists is True:
-        slack_response = client.conversations_list(
-                            cursor = next_cursor,
-                            limit = page_limit,
-                            types = 'public_channel,private_channel')
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        slack_response = method(cursor=next_cursor, **kwargs)
+        yield from slack_response.get(result_key)
+        if slack_response.get('has_more') is False:
+            break
+        metadata = slack_response.get('response_metadata')
+        next_cursor = metadata.get('next_cursor', '') if metadata is not None else ''
+        # next_cursorが空・欠落のどちらでも最終ページとして打ち切る
+        if not next_cursor:
+            break
 
-        channels.extend(slack_response.get('channels'))
-        next_cursor = slack_response.get('response_metadata').get('next_cursor')
-        if next_cursor == "":
-            next_obj_exists = False
 
-    return channels
+def download_conversations_list(
+    client, page_limit: int, exclude_archived: bool=True) -> List[dict]:
+    """download Slack Web API conversations.list response.
+        Returns:
+            [{"id":xx, "name":yy}, {}, ...]
+    """
+    return list(paginate(
+        client.conversations_list, 'channels',
+        limit=page_limit,
+        types='public_channel,private_channel',
+        exclude_archived=exclude_archived))
 
 
 def download_users_list(client, page_limit: int) -> List[dict]:
@@ -49,60 +197,88 @@ def download_users_list(client, page_limit: int) -> List[dict]:
         Returns:
             [{"id":xx, "name":yy}, {}, ...]
     """
-    users = []
-    next_obj_exists = True
-    next_cursor = None
-    while next_obj_exists is True:
-        slack_response = client.users_list(
-                            cursor = next_cursor,
-                            limit = page_limit)
-
-        users.extend(slack_response.get('members'))
-        next_cursor = slack_response.get('response_metadata').get('next_cursor')
-        if next_cursor == "":
-            next_obj_exists = False
-
-    return users
+    return list(paginate(client.users_list, 'members', limit=page_limit))
 
 
-def download_conversations_history(
-    client, channel: str, page_limit: int,
-    latest_unix_time: float, oldest_unix_time: float) -> List[dict]:
-    """download Slack Web API conversations.list response.
+def download_channels_last_activity(
+    client, channel_ids: List[str], rate_limiter: RateLimiter=None) -> dict:
+    """download last message timestamps via Slack Web API conversations.info.
+        conversations.listのペイロードにはlatestが含まれないため、
+        スキップ判定用の最終発言時刻はここでチャンネルごとに取得する。
         Returns:
-            List of dict{"channel":ccc, "message":{ ... }}
+            {channel_id: 最終メッセージのUNIXタイム（不明ならNone）}
     """
-    conversations_by_channel = []
-    next_obj_exists = True
-    next_cursor = None
-    while next_obj_exists is True:
+    last_activity = {}
+    for channel_id in channel_ids:
         try:
-            slack_response = client.conversations_history(
-                                channel = channel,
-                                cursor = next_cursor,
-                                limit = page_limit,
-                                latest = latest_unix_time,
-                                oldest = oldest_unix_time)
-            cnv_by_ch = slack_response.get('messages')
-            for item in cnv_by_ch:
-                item.update( {"channel": channel})
-            conversations_by_channel.extend(cnv_by_ch)
-            if slack_response.get('has_more') is False:
-                next_cursor = ""
-            else:
-                next_cursor = slack_response.get('response_metadata').get('next_cursor')
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            slack_response = client.conversations_info(channel=channel_id)
+            latest = slack_response.get('channel').get('latest')
+            last_activity[channel_id] = float(latest['ts']) if latest else None
         except errors.SlackApiError as e:
-            logging.info(e)
-            break
-        if next_cursor == "":
-            next_obj_exists = False
+            logging.error('failed conversations.info (channel: %s): %s', channel_id, e)
+            last_activity[channel_id] = None
+    return last_activity
+
 
-    return conversations_by_channel
+def download_conversations_history(
+    client, channel: str, page_limit: int,
+    latest_unix_time: float, oldest_unix_time: float,
+    rate_limiter: RateLimiter=None) -> Iterator[dict]:
+    """download Slack Web API conversations.history response.
+        ページ単位で取得してメッセージを逐次yieldするので、
+        チャンネル全体をメモリに載せずに済む。
+        Yields:
+            dict{"channel":ccc, ...message fields...}
+    """
+    try:
+        for item in paginate(
+                client.conversations_history, 'messages',
+                rate_limiter=rate_limiter,
+                channel=channel,
+                limit=page_limit,
+                latest=latest_unix_time,
+                oldest=oldest_unix_time):
+            item['channel'] = channel
+            yield item
+    except errors.SlackApiError as e:
+        # レートリミットや瞬断はSDK側でリトライ済みなので、ここに来るのは
+        # 回復不能なエラー（権限不足など）。ログを残してこのチャンネルを打ち切る
+        logging.error('giving up conversations.history (channel: %s): %s', channel, e)
+
+
+def _download_and_write_history(
+    hist_f, write_lock, client, channel: str, page_limit: int,
+    latest_unix_time: float, oldest_unix_time: float,
+    rate_limiter: RateLimiter=None):
+    """download one channel's history and append it to the shared NDJSON file.
+        書き込みバッファが HISTORY_WRITE_BUFFER_BYTES を超えるたびに
+        ロックを取ってまとめて書き出す（gzipファイルはスレッドセーフでないため）。
+    """
+    buf = bytearray()
+    for msg in download_conversations_history(
+            client=client, channel=channel, page_limit=page_limit,
+            latest_unix_time=latest_unix_time, oldest_unix_time=oldest_unix_time,
+            rate_limiter=rate_limiter):
+        buf += orjson.dumps(msg)
+        buf += b'\n'
+        if len(buf) >= HISTORY_WRITE_BUFFER_BYTES:
+            with write_lock:
+                hist_f.write(buf)
+            buf = bytearray()
+    if len(buf) > 0:
+        with write_lock:
+            hist_f.write(buf)
 
 
 def target_channel_id_name_list(
-    conversations_list: list=None, including_archived: bool=False):
+    conversations_list: list=None, including_archived: bool=False,
+    oldest_ut: float=None, last_activity_ts: dict=None):
     """extract targeted channels id list from conversations_list response.
+        - oldest_ut と last_activity_ts（channel_id -> 最終発言UNIXタイム）を
+          指定した場合、最終発言がそれより古いチャンネルは除外する
+          （historyを呼んでも空なので呼ばない）
         Returns:
             id_list, name_list
     """
@@ -110,7 +286,14 @@ def target_channel_id_name_list(
     name_list = []
     for ch in conversations_list:
         if including_archived is False:
-            if ch['is_archived'] is True:
+            # 基本的にはAPI側で exclude_archived 済みだが、保険として残す
+            if ch.get('is_archived') is True:
+                continue
+        if oldest_ut is not None and last_activity_ts is not None:
+            last_ts = last_activity_ts.get(ch['id'])
+            if last_ts is not None and float(last_ts) < oldest_ut:
+                logging.info('skip channel with no activity in window (ch_id: %s, ch_name: %s)',
+                             ch['id'], ch['name'])
                 continue
         id_list.append(ch['id'])
         name_list.append(ch['name'])
@@ -118,12 +301,10 @@ def target_channel_id_name_list(
 
 
 def exporting_dir(oldest_ut: float=None) -> str:
-    oldest_dt = datetime.datetime.fromtimestamp(oldest_ut)
-    oldest_dt_str = datetime.datetime.strftime(oldest_dt, format='%Y-%m-%d')
-    dir_name = "slack_lake/daily-ingest_target-date_{}".format(oldest_dt_str)
-    dir_path = f"{SCRIPT_DIR}/{dir_name}"
-    Path(dir_path).mkdir(parents=True, exist_ok=True)
-    return dir_path
+    oldest_date_str = datetime.date.fromtimestamp(oldest_ut).isoformat()
+    dir_path = SLACK_LAKE_DIR / f"daily-ingest_target-date_{oldest_date_str}"
+    os.makedirs(dir_path, exist_ok=True)
+    return str(dir_path)
 
 
 # ==  BEGIN - Main Cloud Function  ==
@@ -141,63 +322,96 @@ def ingest_slack_data(request, **kwargs):
             oldest_ut: データ取得対象の最古タイムスタンプ（UNIXタイム）
             bucket_name: 保存先のバケット名
     """
-    # ボットトークンと署名シークレットを使ってアプリを初期化します
-    app = App(
-        # process_before_response must be True when running on FaaS
-        process_before_response=True,
-        token=os.environ.get("SLACK_BOT_TOKEN"),
-        signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
-    )
+    _configure_logging()
 
     # Settings
     _conditions = {}
     if request is None: # locally test
         _conditions = kwargs
     else : # production environment
-        req_data = request.get_json()
-        _conditions = {} if req_data is None else req_data
+        req_body = request.get_data()
+        _conditions = {} if len(req_body) == 0 else orjson.loads(req_body)
     print('■ request json data\n', _conditions)
-    latest_unix_time = _conditions['latest_ut'] if ('latest_ut' in _conditions.keys()) else None
-    oldest_unix_time = _conditions['oldest_ut'] if ('oldest_ut' in _conditions.keys()) else None
-    bucket_name = _conditions['bucket_name'] if ('bucket_name' in _conditions.keys()) else None
+    latest_unix_time = _conditions.get('latest_ut')
+    oldest_unix_time = _conditions.get('oldest_ut')
+    bucket_name = _conditions.get('bucket_name')
 
     # 時刻が明示されていない場合は、通常のデイリー実行を前提として
     # データ取得期間を定義する
     if latest_unix_time is None or oldest_unix_time is None:
-        tz = pytz.timezone('Asia/Tokyo')
+        tz = ZoneInfo('Asia/Tokyo')
         start_of_today = datetime.datetime.now(tz).replace(hour=0,minute=0,second=0,microsecond=0)
         latest_unix_time = start_of_today.timestamp()
         start_of_yesterday = start_of_today - datetime.timedelta(days=1)
         oldest_unix_time = start_of_yesterday.timestamp()
     out_dir = exporting_dir(oldest_ut=oldest_unix_time)
-    logging.info('out_dir : {}'.format(out_dir))
-    logging.info('oldest_ut : {}'.format(oldest_unix_time) + ' | latest_ut : {}'.format(latest_unix_time))
+    logging.info('out_dir : %s', out_dir)
+    logging.info('oldest_ut : %s | latest_ut : %s', oldest_unix_time, latest_unix_time)
 
-    client = app.client
+    if request is None: # CLI/batch mode: Web APIしか使わないのでAppを経由しない
+        client = _get_client()
+    else:
+        client = _get_app().client
 
     # ingest channles list
-    channels = download_conversations_list(client=client, page_limit=100)
+    # ワークスペース全体のリストは日次バッチで毎回同じ内容になるため、
+    # ローカルキャッシュ（TTL: 24h）を挟んで再取得を避ける
+    channels = cached_slack_call(
+        cache_path=CACHE_DIR + '/' + 'conversations_list.json',
+        ttl_seconds=CACHE_TTL_SECONDS,
+        fetch_fn=lambda: download_conversations_list(client=client, page_limit=1000))
     save_as_json(channels, out_dir + '/' + 'conversations_list.json')
 
     # ingest users list
-    users = download_users_list(client=client, page_limit=100)
+    users = cached_slack_call(
+        cache_path=CACHE_DIR + '/' + 'users_list.json',
+        ttl_seconds=CACHE_TTL_SECONDS,
+        fetch_fn=lambda: download_users_list(client=client, page_limit=1000))
     save_as_json(users, out_dir + '/' + 'users_list.json')
 
     # ingest conversations history
-    channel_id_list, channel_name_list = target_channel_id_name_list(channels, including_archived=False)
-    conversations = []
-    for channel_id, channel_name in zip(channel_id_list, channel_name_list):
-        logging.info('download conversations (ch_id: {0}, ch_name: {1})'.format(
-            channel_id, channel_name))
-        conversations_by_ch = download_conversations_history(
-            client=client, channel=channel_id, page_limit=100, latest_unix_time=latest_unix_time, oldest_unix_time=oldest_unix_time
-        )
-        if len(conversations_by_ch) > 0:
-            conversations.extend(conversations_by_ch)
-    save_as_json(conversations, out_dir + '/' + 'conversations_history.json')
+    # 会話履歴の取得はチャンネルごとに独立したI/Oバウンド処理なので、
+    # スレッドプールで並列化する（レートリミッタでTier-3制限を超えないようにする）
+    # 全チャンネル分をメモリに溜め込まず、チャンネルごとに取得完了し次第
+    # 1メッセージ=1行のJSON（NDJSON）として逐次書き出す
+    rate_limiter = RateLimiter(max_calls=HISTORY_REQUESTS_PER_MINUTE)
+    # 対象期間に発言のないチャンネルを除外するための最終発言時刻マップ。
+    # min_mtime=latest_unix_time により、スナップショットが対象期間の終端より
+    # 古い場合はキャッシュを使わず再取得する（期間内の発言の見落とし防止）
+    last_activity = cached_slack_call(
+        cache_path=CACHE_DIR + '/' + 'channels_last_activity.json',
+        ttl_seconds=CACHE_TTL_SECONDS,
+        min_mtime=latest_unix_time,
+        fetch_fn=lambda: download_channels_last_activity(
+            client, [ch['id'] for ch in channels], rate_limiter=rate_limiter))
+    channel_id_list, channel_name_list = target_channel_id_name_list(
+        channels, including_archived=False, oldest_ut=oldest_unix_time,
+        last_activity_ts=last_activity)
+    history_path = out_dir + '/' + 'conversations_history.jsonl.gz'
+    # Slackメッセージはgzipでおおよそ1桁圧縮できるので、書き出し時点で圧縮する
+    # （compresslevel=3はCPU負荷を抑えつつ圧縮率の大半を得られる）
+    write_lock = threading.Lock()
+    with gzip.open(history_path, 'wb', compresslevel=GZIP_COMPRESS_LEVEL) as hist_f, \
+            ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        future_to_channel = {}
+        for channel_id, channel_name in zip(channel_id_list, channel_name_list):
+            logging.info('download conversations (ch_id: %s, ch_name: %s)',
+                         channel_id, channel_name)
+            future = executor.submit(
+                _download_and_write_history,
+                hist_f=hist_f, write_lock=write_lock,
+                # conversations.historyのlimit上限は999（1000はinvalid_limitになる）
+                client=client, channel=channel_id, page_limit=999,
+                latest_unix_time=latest_unix_time, oldest_unix_time=oldest_unix_time,
+                rate_limiter=rate_limiter
+            )
+            future_to_channel[future] = channel_id
+        for future in as_completed(future_to_channel):
+            future.result()
+    logging.info('save %s', history_path)
 
     # # save completing log
-    # tz = pytz.timezone('Asia/Tokyo')
+    # tz = ZoneInfo('Asia/Tokyo')
     # now = datetime.datetime.now(tz)
     # ingest_log = {'ingested_at_ts': now.timestamp(), 'ingested_at': now.strftime('%Y-%m-%d %H:%M:%S')}
     # save_into_bucket(ingest_log, bucket, out_dir + '/' + 'ingest_log.json')
@@ -216,15 +430,21 @@ def ingest_slack_data(request, **kwargs):
 # ==  BEGIN - Sub Cloud Function for Test  ==
 def save_as_json(data: List[dict], fname: str=None):
     """save response data as json
+        - fname が .gz で終わる場合はgzip圧縮して書き出す
     """
-    with open(fname, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-        logging.info('save {}'.format(fname))
+    if fname.endswith('.gz'):
+        f = gzip.open(fname, 'wb', compresslevel=GZIP_COMPRESS_LEVEL)
+    else:
+        f = open(fname, 'wb')
+    with f:
+        f.write(orjson.dumps(data))
+        logging.info('save %s', fname)
 # ==  END - Sub Cloud Function for Test  ==
 
 
 # run app
 if __name__ == "__main__":
+    _configure_logging()
     # parse args
     args = sys.argv
     latest_ut = 0